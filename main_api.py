@@ -3,33 +3,361 @@
 #  Version : 6.2 (Synchronisation Finale avec le Frontend)
 #  Date : 14/09/2025
 # =============================================================================
-import os; import json; import google.generativeai as genai; import googlemaps; import re; import jwt
-from fastapi import FastAPI, HTTPException, Depends, status
-from pydantic import BaseModel, EmailStr
+import os; import json; import time; import asyncio; import orjson; import httpx; import numpy as np; import google.generativeai as genai; import jwt; import anyio.to_thread
+import hashlib; import hmac; import base64
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response, BackgroundTasks
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic_core import from_json
+from pydantic import BaseModel, EmailStr, TypeAdapter
 from typing import List, Dict, Optional
-from fastapi.middleware.cors import CORSMiddleware
+from itertools import islice
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
+import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 from datetime import datetime, timedelta, timezone, date
-from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel import Field, SQLModel, select
+from sqlalchemy import update, Index, event
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from cachetools import LRUCache, TTLCache
+import redis.asyncio as aioredis
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from google.api_core.exceptions import InternalServerError, ResourceExhausted, ServiceUnavailable
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import logging
+
+logger = logging.getLogger("caducee")
 
 # --- 1. CONFIGURATION ---
 load_dotenv()
-app = FastAPI(title="Caducée API", version="6.2.0")
-origins = ["*"]
-app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-SECRET_KEY = os.environ.get("SECRET_KEY", "secret_dev_key")
-ALGORITHM = "HS256"; ACCESS_TOKEN_EXPIRE_MINUTES = 60
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Configuration figée au démarrage : les handlers lisent un attribut au lieu
+# de refaire un os.environ.get (proxy + décodage) à chaque requête.
+@dataclass(frozen=True, slots=True)
+class Settings:
+    google_api_key: Optional[str]; google_maps_api_key: Optional[str]
+    secret_key: str; database_url: str; gemini_concurrency: int; redis_url: Optional[str]
+
+SETTINGS = Settings(
+    google_api_key=os.environ.get("GOOGLE_API_KEY"),
+    google_maps_api_key=os.environ.get("GOOGLE_MAPS_API_KEY"),
+    secret_key=os.environ.get("SECRET_KEY", "secret_dev_key"),
+    database_url=os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///./caducee.db"),
+    gemini_concurrency=int(os.environ.get("GEMINI_CONCURRENCY", "15")),  # aligné sur le palier RPM du compte
+    redis_url=os.environ.get("REDIS_URL"),  # optionnel : cache de réponses partagé entre workers
+)
+
+GEMINI_MODEL = None  # modèle "pro", instancié une seule fois au démarrage (lifespan)
+FAST_MODEL = None  # modèle "flash" pour les décisions courtes (classer, prochaine question)
+# Bloc fixe ROLE/FORMAT porté une seule fois par le modèle (system_instruction) au lieu
+# d'être concaténé dans chaque prompt : moins de tokens variables, préfixe stable côté
+# serveur. (CachedContent exige un minimum de ~32k tokens : hors de portée de ces prompts.)
+_SYSTEM_INSTRUCTION = ("Tu es un assistant médical IA prudent. Tu ne poses jamais de diagnostic définitif. "
+                       "Réponds UNIQUEMENT par l'objet JSON demandé, sans texte autour.")
+GEMINI_SEM = asyncio.Semaphore(SETTINGS.gemini_concurrency)
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None  # pool de connexions partagé (keep-alive, TLS amorti)
+_PLACES_NEARBY_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+_PLACE_URL = "https://www.google.com/maps/place/?q=place_id:"
+
+# Reprise sur erreurs transitoires Gemini (quota, 5xx) : 3 tentatives avec backoff
+# exponentiel + jitter, au lieu de renvoyer 503 au premier raté et forcer le client
+# à repayer tout l'aller-retour. Le sémaphore est relâché pendant l'attente.
+@retry(retry=retry_if_exception_type((ResourceExhausted, InternalServerError, ServiceUnavailable)),
+       stop=stop_after_attempt(3), wait=wait_exponential_jitter(initial=1, max=8), reraise=True)
+async def call_gemini(model, prompt):
+    async with GEMINI_SEM:  # borne le nombre d'appels Gemini en vol
+        return await model.generate_content_async(prompt)
+
+# Micro-batching de /analysis : sous charge, les demandes arrivées dans une même
+# fenêtre de 20 ms sont fusionnées en un seul prompt (tableau JSON), ce qui amortit
+# l'aller-retour RPC. Au-delà d'un décodage séquentiel rentable, on retombe sur des
+# appels individuels en parallèle.
+GEMINI_MICROBATCH = int(os.environ.get("GEMINI_MICROBATCH", "4"))
+GEMINI_BATCH_WINDOW_MS = 20
+_ANALYSIS_QUEUE: asyncio.Queue = asyncio.Queue()
+_BATCHER_TASK: Optional[asyncio.Task] = None
+_PROMPT_BATCH_PREFIX = ("Analyse chacun des cas patients suivants, indépendamment les uns des autres.\n"
+                        "Réponds UNIQUEMENT par un tableau JSON contenant exactement un objet par cas, dans le même ordre.\n")
+
+async def submit_analysis(profile: str, symptoms: str) -> dict:
+    fut = asyncio.get_running_loop().create_future()
+    await _ANALYSIS_QUEUE.put((profile, symptoms, fut))
+    return await fut
+
+# Single-flight : des prompts strictement identiques en vol au même instant (lien
+# viral, double-clic) partagent un seul appel amont, les suiveurs attendent la Future.
+IN_FLIGHT: dict = {}
+
+async def ask_gemini_json(prompt: str, model=None) -> dict:
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    existing = IN_FLIGHT.get(key)
+    if existing is not None: return await existing
+    fut = asyncio.get_running_loop().create_future()
+    IN_FLIGHT[key] = fut
+    try:
+        response = await call_gemini(model if model is not None else GEMINI_MODEL, prompt)
+        result = clean_gemini_response(response.text)
+        fut.set_result(result); return result
+    except Exception as e:
+        fut.set_exception(e); fut.exception()  # marque l'exception comme consommée si aucun suiveur
+        raise
+    finally:
+        IN_FLIGHT.pop(key, None)
+
+async def _single_analysis(profile: str, symptoms: str) -> dict:
+    return await ask_gemini_json(build_analysis_prompt(profile, symptoms))
+
+async def _dispatch_analysis_batch(batch):
+    if len(batch) == 1:
+        profile, symptoms, fut = batch[0]
+        try: fut.set_result(await _single_analysis(profile, symptoms))
+        except Exception as e: fut.set_exception(e)
+        return
+    prompt = _PROMPT_BATCH_PREFIX + "".join(f'Cas {i + 1}: {p}\nSymptômes: "{s}"\n' for i, (p, s, _) in enumerate(batch))
+    try:
+        response = await call_gemini(GEMINI_MODEL, prompt)
+        start = response.text.find("[")
+        arr = from_json(response.text[start:], allow_partial='trailing-strings') if start != -1 else None
+        if not isinstance(arr, list) or len(arr) != len(batch): raise ValueError("Réponse batch invalide")
+        for (_, _, fut), item in zip(batch, arr): fut.set_result(item)
+    except Exception:  # repli : appels individuels en parallèle (max(t_i), pas sum(t_i))
+        results = await asyncio.gather(*[_single_analysis(p, s) for p, s, _ in batch], return_exceptions=True)
+        for (_, _, fut), res in zip(batch, results):
+            if isinstance(res, Exception): fut.set_exception(res)
+            else: fut.set_result(res)
+
+async def _analysis_batcher():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _ANALYSIS_QUEUE.get()]
+        deadline = loop.time() + GEMINI_BATCH_WINDOW_MS / 1000
+        while len(batch) < GEMINI_MICROBATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0: break
+            try: batch.append(await asyncio.wait_for(_ANALYSIS_QUEUE.get(), timeout))
+            except asyncio.TimeoutError: break
+        asyncio.create_task(_dispatch_analysis_batch(batch))
+
+# Extraction du JSON renvoyé par Gemini : une seule passe regex précompilée
+# au lieu de strip + deux .replace (trois parcours et allocations par réponse).
+async def stream_gemini_ndjson(model, prompt, stop_after: Optional[set] = None):
+    """Streame la réponse Gemini en NDJSON : chaque champ JSON est émis dès qu'il
+    est complet (parse partiel pydantic-core), sans attendre la fin de la génération.
+    Si `stop_after` est fourni, le flux amont est abandonné dès que ces champs sont
+    sortis — inutile de payer les tokens restants."""
+    buf = ""; sent_keys = set()
+    try:
+        async with GEMINI_SEM:
+            stream = await model.generate_content_async(prompt, stream=True)
+            async for chunk in stream:
+                buf += chunk.text
+                start = buf.find("{")
+                if start == -1: continue
+                try: partial = from_json(buf[start:], allow_partial=True)
+                except ValueError: continue
+                if not isinstance(partial, dict): continue
+                keys = list(partial)
+                for key in keys[:-1]:  # la dernière clé vue peut encore être tronquée
+                    if key not in sent_keys:
+                        sent_keys.add(key); yield orjson.dumps({key: partial[key]}) + b"\n"
+                if stop_after is not None and stop_after <= sent_keys: break
+        yield orjson.dumps({"analysis": clean_gemini_response(buf)}) + b"\n"
+    except Exception as e:
+        yield orjson.dumps({"error": f"Erreur IA: {e}"}) + b"\n"
+def _scan_json_object(raw_text: str, start: int) -> Optional[str]:
+    # Filet de sécurité : une seule passe avec compteur d'accolades et état chaîne/échappement,
+    # sans moteur regex ni balayage glouton de toute la réponse.
+    depth = 0; in_string = False; escape = False
+    for i in range(start, len(raw_text)):
+        c = raw_text[i]
+        if escape: escape = False
+        elif in_string:
+            if c == "\\": escape = True
+            elif c == '"': in_string = False
+        elif c == '"': in_string = True
+        elif c == "{": depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0: return raw_text[start:i + 1]
+    return None
+
+def clean_gemini_response(raw_text: str) -> dict:
+    # Chemin principal : parse SIMD (jiter) en une passe depuis la première accolade,
+    # tolérant fences markdown et prose finales ; le scanner ne sert que de filet de sécurité.
+    logger.debug("Réponse brute de Gemini: %s", raw_text)  # %-lazy : rien n'est formaté si DEBUG est coupé
+    start = raw_text.find("{")
+    if start == -1: raise ValueError("Aucun objet JSON dans la réponse du modèle.")
+    try:
+        data = from_json(raw_text[start:], allow_partial='trailing-strings')
+        if isinstance(data, dict): return data
+    except ValueError: pass
+    candidate = _scan_json_object(raw_text, start)
+    if candidate is None: raise ValueError("Aucun objet JSON dans la réponse du modèle.")
+    return orjson.loads(candidate)
+
+# Cache LRU des réponses Gemini : les symptômes identiques (une fois normalisés)
+# sont servis en microsecondes au lieu de repayer la latence complète du modèle.
+ANALYSIS_CACHE = LRUCache(maxsize=2048)
+REFINE_CACHE = LRUCache(maxsize=1024)
+USER_CACHE = TTLCache(maxsize=10_000, ttl=60)  # token brut -> (User, exp) : évite décodage JWT + requête DB à chaque appel
+
+# Étage distant optionnel (REDIS_URL) : partagé entre les workers gunicorn, il sert les
+# requêtes chaudes qu'un process fraîchement recyclé n'a pas encore dans ses LRU locaux.
+REDIS_CLIENT = None
+REDIS_ANALYSIS_TTL = 86400
+
+async def redis_get_json(key: str):
+    if REDIS_CLIENT is None: return None
+    try:
+        raw = await REDIS_CLIENT.get(key)
+        return orjson.loads(raw) if raw is not None else None
+    except Exception: return None  # un Redis injoignable ne doit jamais casser la requête
+
+async def redis_set_json(key: str, value, ttl: int = REDIS_ANALYSIS_TTL):
+    if REDIS_CLIENT is None: return
+    try: await REDIS_CLIENT.setex(key, ttl, orjson.dumps(value))
+    except Exception: pass
+
+# Cache sémantique : des formulations voisines du même symptôme ("mal de tête et
+# fièvre" / "fièvre avec maux de tête") partagent la réponse via plus proche voisin
+# cosinus sur les embeddings Gemini, au lieu d'exiger une égalité stricte.
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE", "1") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+_SEMANTIC_MAX = 2048
+_semantic_vectors: Optional[np.ndarray] = None  # (n, d), lignes normalisées
+_semantic_payloads: list = []
+
+async def embed_for_cache(text: str) -> np.ndarray:
+    result = await genai.embed_content_async(model="models/text-embedding-004", content=text)
+    vec = np.asarray(result["embedding"], dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+def semantic_lookup(vec: np.ndarray):
+    if _semantic_vectors is None or not _semantic_payloads: return None
+    scores = _semantic_vectors @ vec
+    best = int(scores.argmax())
+    return _semantic_payloads[best] if scores[best] >= SEMANTIC_CACHE_THRESHOLD else None
+
+def semantic_store(vec: np.ndarray, payload):
+    global _semantic_vectors
+    if _semantic_vectors is None: _semantic_vectors = vec[None, :]
+    else: _semantic_vectors = np.vstack((_semantic_vectors[-(_SEMANTIC_MAX - 1):], vec[None, :]))
+    _semantic_payloads.append(payload)
+    del _semantic_payloads[:-_SEMANTIC_MAX]
+def normalize_symptoms(s: str) -> str: return " ".join(s.lower().split())[:512]
+
+# Cache des recherches Places : un geohash-6 couvre ~1,2 km, donc les utilisateurs
+# d'un même quartier partagent le résultat pendant une heure (quota et latence économisés).
+PLACES_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+_PLACES_LOCKS: dict = {}  # single-flight par geohash : N ratés concurrents -> 1 appel API
+_GEOHASH_B32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash6(lat: float, lng: float) -> str:
+    lat_lo, lat_hi, lng_lo, lng_hi = -90.0, 90.0, -180.0, 180.0
+    bits = 0
+    for i in range(30):  # 6 caractères * 5 bits, longitude d'abord
+        if i % 2 == 0:
+            mid = (lng_lo + lng_hi) / 2
+            if lng > mid: bits = bits << 1 | 1; lng_lo = mid
+            else: bits <<= 1; lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat > mid: bits = bits << 1 | 1; lat_lo = mid
+            else: bits <<= 1; lat_hi = mid
+    return "".join(_GEOHASH_B32[(bits >> shift) & 0x1F] for shift in range(25, -1, -5))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global GEMINI_MODEL, HTTP_CLIENT
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 100  # hash de mots de passe concurrents
+    HTTP_CLIENT = httpx.AsyncClient(http2=True, timeout=30.0, limits=httpx.Limits(max_connections=100, max_keepalive_connections=50))
+    await create_db_and_tables()
+    global _BATCHER_TASK, FAST_MODEL, REDIS_CLIENT
+    if SETTINGS.redis_url: REDIS_CLIENT = aioredis.from_url(SETTINGS.redis_url)
+    if SETTINGS.google_api_key:
+        genai.configure(api_key=SETTINGS.google_api_key)  # le SDK garde ensuite un seul transport pour tout le process
+        # response_mime_type JSON : le modèle sort du JSON brut (ni prose ni fences) ;
+        # clean_gemini_response prend alors son chemin rapide et ne sert plus que de filet.
+        _gen_cfg = {"response_mime_type": "application/json"}
+        GEMINI_MODEL = genai.GenerativeModel('gemini-1.5-pro-latest', system_instruction=_SYSTEM_INSTRUCTION, generation_config=_gen_cfg)
+        # flash ~10x plus rapide et moins cher : suffisant pour les sorties courtes du raffinement
+        FAST_MODEL = genai.GenerativeModel('gemini-1.5-flash-latest', system_instruction=_SYSTEM_INSTRUCTION, generation_config=_gen_cfg)
+        _BATCHER_TASK = asyncio.create_task(_analysis_batcher())
+    # Chauffe des chemins froids pour que la première vraie requête ne paie pas
+    # l'init du backend JWT, le chargement d'argon2 ni la compilation des validateurs Pydantic.
+    decode_access_token(create_access_token({"sub": "_warmup"}))
+    _ANALYSIS_TA.validate_python({"symptom": ""}); _REFINE_TA.validate_python({})
+    await anyio.to_thread.run_sync(get_password_hash, "_warmup")  # importe le backend natif hors requête
+    yield
+    if _BATCHER_TASK is not None: _BATCHER_TASK.cancel()
+    if REDIS_CLIENT is not None: await REDIS_CLIENT.aclose()
+    await HTTP_CLIENT.aclose()
+
+class ASGICORSMiddleware:
+    """CORS en pur ASGI : en-têtes pré-encodés en bytes à la construction, pré-vol
+    OPTIONS court-circuité avant le routeur — pas de machinerie Starlette pour un
+    simple travail d'en-têtes sur le chemin chaud."""
+    _PREFLIGHT_STATIC = ((b"access-control-allow-methods", b"*"), (b"access-control-allow-credentials", b"true"),
+                         (b"access-control-max-age", b"600"), (b"vary", b"Origin"))
+    _SIMPLE_STATIC = ((b"access-control-allow-credentials", b"true"), (b"vary", b"Origin"))
+    def __init__(self, app, allowed_origins):
+        self.app = app
+        self.allowed = frozenset(o.encode() for o in allowed_origins)
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        origin = None
+        for k, v in scope["headers"]:
+            if k == b"origin": origin = v; break
+        if origin is None or origin not in self.allowed: return await self.app(scope, receive, send)
+        if scope["method"] == "OPTIONS":
+            req_headers = next((v for k, v in scope["headers"] if k == b"access-control-request-headers"), b"*")
+            headers = [(b"access-control-allow-origin", origin), (b"access-control-allow-headers", req_headers), *self._PREFLIGHT_STATIC]
+            await send({"type": "http.response.start", "status": 204, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), (b"access-control-allow-origin", origin), *self._SIMPLE_STATIC]
+            await send(message)
+        await self.app(scope, receive, send_with_cors)
+
+app = FastAPI(title="Caducée API", version="6.2.0", lifespan=lifespan, default_response_class=ORJSONResponse)
+# "*" + allow_credentials est invalide (le navigateur le refuse) et force Starlette à
+# faire un écho origine par origine ; liste explicite, surchargeable via ALLOWED_ORIGINS.
+origins = [o.strip() for o in os.environ.get("ALLOWED_ORIGINS", "http://localhost:3000,http://localhost:8000").split(",") if o.strip()]
+# Les recommandations font plusieurs Ko de prose : gzip divise le transfert par 3-5
+# sur mobile ; seuil à 512 octets pour ne pas compresser les petites réponses JSON.
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+app.add_middleware(ASGICORSMiddleware, allowed_origins=origins)  # ajouté en dernier : couche la plus externe
+SECRET_KEY = SETTINGS.secret_key
+ALGORITHM = "HS256"; ACCESS_TOKEN_EXPIRE_MINUTES = 60; ACCESS_TOKEN_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+pwd_hasher = PasswordHasher(time_cost=2, memory_cost=46 * 1024, parallelism=1)  # profil Argon2id OWASP
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-DATABASE_URL = "sqlite:///./caducee.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-def create_db_and_tables(): SQLModel.metadata.create_all(engine)
-@app.on_event("startup")
-def on_startup(): create_db_and_tables()
-def get_session():
-    with Session(engine) as session: yield session
+DATABASE_URL = SETTINGS.database_url
+if DATABASE_URL.startswith("postgres://"): DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql+asyncpg://", 1)  # URL fournie par Render
+elif DATABASE_URL.startswith("postgresql://"): DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+if DATABASE_URL.startswith("postgresql+asyncpg"):
+    engine = create_async_engine(DATABASE_URL, pool_size=20, max_overflow=10, pool_pre_ping=True)
+else:
+    engine = create_async_engine(DATABASE_URL)
+    if DATABASE_URL.startswith("sqlite"):
+        # WAL : les lectures ne bloquent plus sur l'unique écrivain ; synchronous=NORMAL
+        # suffit sous WAL et supprime la plupart des fsync du chemin d'écriture.
+        @event.listens_for(engine.sync_engine, "connect")
+        def _sqlite_pragmas(dbapi_conn, _record):
+            cur = dbapi_conn.cursor()
+            for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY",
+                           "cache_size=-64000", "mmap_size=268435456"):
+                cur.execute(f"PRAGMA {pragma}")
+            cur.close()
+async def create_db_and_tables():
+    async with engine.begin() as conn: await conn.run_sync(SQLModel.metadata.create_all)
+async def get_session():
+    async with AsyncSession(engine) as session: yield session
 
 # --- 2. MODÈLES DE DONNÉES ---
 class User(SQLModel, table=True):
@@ -39,10 +367,12 @@ class User(SQLModel, table=True):
     address: Optional[str] = None; phone_number: Optional[str] = None
     sex: Optional[str] = None; medical_history: Optional[str] = None; allergies: Optional[str] = None
 class Consultation(SQLModel, table=True):
+    # index composite : l'historique d'un utilisateur se lit trié par date sans table scan
+    __table_args__ = (Index("ix_consultation_owner_created", "owner_email", "created_at"),)
     id: Optional[int] = Field(default=None, primary_key=True); symptom: str
     final_recommendation: str; severity_level: str
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    owner_email: str = Field(foreign_key="user.email")
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))  # utcnow() est déprécié et naïf
+    owner_email: str = Field(foreign_key="user.email", index=True)
 
 # --- 3. MODÈLES D'API (Pydantic) ---
 class Token(BaseModel): access_token: str; token_type: str
@@ -59,86 +389,252 @@ class UserUpdate(BaseModel):
     sex: Optional[str] = None; medical_history: Optional[str] = None; allergies: Optional[str] = None
 class ConsultationPublic(BaseModel): id: int; symptom: str; final_recommendation: str; severity_level: str; created_at: datetime
 class SymptomRequest(BaseModel): symptoms: str
-class AnalysisResponse(BaseModel): symptom: str; differential_diagnoses: List[str]; first_question: str; answer_type: str; recommendations: List[str]; disclaimer: str
-class RefineRequest(BaseModel): symptoms: str; history: List[Dict[str, str]]
+class AnalysisResponse(BaseModel):
+    symptom: str = "N/A"; differential_diagnoses: List[str] = []; first_question: str = ""
+    answer_type: str = "yes_no"; recommendations: List[str] = []; disclaimer: str = ""
+class HistoryItem(BaseModel): question: str; answer: str
+class RefineRequest(BaseModel): symptoms: str; history: List[HistoryItem]
 class RefineResponse(BaseModel): next_question: Optional[str] = None; answer_type: str = "yes_no"; final_recommendation: Optional[str] = None; severity_level: Optional[str] = None
 class NearbyDoctorsRequest(BaseModel): latitude: float; longitude: float
 class Doctor(BaseModel): name: str; address: str; rating: Optional[float] = None; url: str
+class RefineWithDoctorsRequest(BaseModel): symptoms: str; history: List[HistoryItem]; latitude: float; longitude: float
+class RefineWithDoctorsResponse(BaseModel): refine: RefineResponse; doctors: List[Doctor]
+_REFINE_TA = TypeAdapter(RefineResponse)  # validateur compilé une fois, réutilisé à chaque réponse Gemini
+_ANALYSIS_TA = TypeAdapter(AnalysisResponse)
+
+# --- 3bis. PROMPTS (partie fixe évaluée une seule fois au chargement) ---
+_PROMPT_ANALYSIS_MID = '\nAnalyse: "'
+_PROMPT_ANALYSIS_SUFFIX = '".\nRéponse JSON...'
+_PROMPT_REFINE_MID = '\nSymptômes: "'
+_PROMPT_REFINE_HIST = '".\nHistorique: '
+# Le raffinement est éclaté en sous-prompts spécialisés courts : le décodage LLM est
+# autorégressif, donc 2 réponses de ~10 et ~40 tokens lancées en parallèle coûtent
+# max(t_i) là où une réponse combinée les additionne.
+_PROMPT_CLASSIFY = ('\nTACHE: Réponds UNIQUEMENT par un objet JSON {"done": true|false} : true si les informations '
+                    'recueillies suffisent pour émettre une recommandation finale, false sinon.')
+_PROMPT_NEXT_QUESTION = ('\nTACHE: Réponds UNIQUEMENT par un objet JSON {"next_question": "...", "answer_type": "yes_no"} '
+                         'donnant la prochaine question à poser au patient.')
+_PROMPT_RECOMMENDATION = ('\nTACHE: Réponds UNIQUEMENT par un objet JSON {"final_recommendation": "...", "severity_level": "..."} '
+                          'donnant la recommandation finale et le niveau de gravité.')
+def user_profile_context(user: User) -> str:
+    age = "inconnu"
+    if user.birth_date:
+        today = date.today()
+        age = today.year - user.birth_date.year - ((today.month, today.day) < (user.birth_date.month, user.birth_date.day))
+    return f"Contexte patient: Âge {age}, Sexe {user.sex}."
+def build_analysis_prompt(profile: str, symptoms: str) -> str:
+    return "".join((profile, _PROMPT_ANALYSIS_MID, symptoms, _PROMPT_ANALYSIS_SUFFIX))
+def build_refine_context(profile: str, symptoms: str, history_str: str) -> str:
+    return "".join((profile, _PROMPT_REFINE_MID, symptoms, _PROMPT_REFINE_HIST, history_str))
+def build_history_str(history: List[HistoryItem]) -> str:
+    # un seul join sur des fragments, pas de liste intermédiaire de f-strings par tour
+    buf = []
+    for h in history:
+        if buf: buf.append("\n")
+        buf += ("Q: ", h.question, "\nA: ", h.answer)
+    return "".join(buf)
 
 # --- 4. FONCTIONS UTILITAIRES & SÉCURITÉ ---
-def verify_password(p, h): return pwd_context.verify(p, h)
-def get_password_hash(p): return pwd_context.hash(p)
+def verify_password(p, h):
+    try: pwd_hasher.verify(h, p); return True
+    except VerifyMismatchError: return False
+    except InvalidHashError:  # ancien hash bcrypt (ère passlib), vérifié en direct
+        try: return bcrypt.checkpw(p.encode(), h.encode())
+        except ValueError: return False
+def get_password_hash(p): return pwd_hasher.hash(p)
+def password_needs_rehash(h): return not h.startswith("$argon2") or pwd_hasher.check_needs_rehash(h)
+# Fenêtre courte où une reconnexion identique ne repaie pas Argon2 (clients automatisés
+# qui re-loggent en rafale avant de passer au token). La clé est un HMAC-SECRET de
+# (email, sha256(mdp)) : rien d'exploitable ne réside en mémoire, seuls les succès
+# sont mémorisés, et le TTL de 10 s borne l'exposition après changement de mot de passe.
+_PW_CACHE = TTLCache(maxsize=1024, ttl=10)
+def _pw_cache_key(email: str, password: str) -> bytes:
+    return hmac.new(SECRET_KEY.encode(), email.encode() + b"|" + hashlib.sha256(password.encode()).digest(), hashlib.sha256).digest()
+# Etat JWT préparé une fois : clé validée + payload sérialisé via orjson, en
+# passant par api_jws pour éviter la re-préparation de l'algorithme à chaque appel.
+_JWT_ALG = jwt.algorithms.get_default_algorithms()[ALGORITHM]
+_JWT_KEY = _JWT_ALG.prepare_key(SECRET_KEY.encode())
+# Encodage manuel : l'en-tête {"alg":"HS256","typ":"JWT"} ne change jamais, on le
+# pré-encode ; il reste un orjson.dumps, un base64 et un HMAC par token.
+_JWT_HEADER_B64 = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
 def create_access_token(data: dict):
-    to_encode = data.copy(); expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire}); return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-async def get_current_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)):
+    payload = {**data, "exp": int(time.time()) + ACCESS_TOKEN_EXPIRE_SECONDS}  # exp numérique, RFC 7519
+    signing_input = _JWT_HEADER_B64 + b"." + base64.urlsafe_b64encode(orjson.dumps(payload)).rstrip(b"=")
+    signature = hmac.new(_JWT_KEY, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + base64.urlsafe_b64encode(signature).rstrip(b"=")).decode()
+def decode_access_token(token: str) -> dict:
+    payload = orjson.loads(jwt.api_jws.decode(token, _JWT_KEY, algorithms=[ALGORITHM]))
+    if payload.get("exp", 0) < time.time(): raise jwt.ExpiredSignatureError("Token expiré")  # api_jws ne contrôle pas exp
+    return payload
+def invalidate_user_cache(email: str):
+    for k in [k for k, v in USER_CACHE.items() if v[0].email == email]: USER_CACHE.pop(k, None)
+async def get_current_user(token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_session)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+    hit = USER_CACHE.get(token)
+    if hit is not None:
+        user, exp = hit
+        if exp > time.time(): return user  # le TTL du cache ne doit pas survivre à l'expiration du token
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]); email: str = payload.get("sub")
+        payload = decode_access_token(token); email: str = payload.get("sub")
         if email is None: raise credentials_exception
-    except jwt.PyJWTError: raise credentials_exception
-    user = session.get(User, email)
+    except (jwt.PyJWTError, ValueError): raise credentials_exception
+    user = await session.get(User, email)
     if user is None: raise credentials_exception
+    USER_CACHE[token] = (user, payload.get("exp", 0))
     return user
 
 # --- 5. ENDPOINTS API ---
+# Corps de statut pré-sérialisé + ETag fort : les pings des moniteurs repartent
+# en 304 sans re-sérialisation ni octet de corps.
+_ROOT_BODY = orjson.dumps({"status": "Caducée API v6.2 (Stable) est en ligne."})
+_ROOT_ETAG = '"' + hashlib.blake2b(_ROOT_BODY, digest_size=8).hexdigest() + '"'
 @app.get("/", tags=["Status"])
-def read_root(): return {"status": "Caducée API v6.2 (Stable) est en ligne."}
+def read_root(request: Request):
+    if request.headers.get("if-none-match") == _ROOT_ETAG: return Response(status_code=304)
+    return Response(content=_ROOT_BODY, media_type="application/json", headers={"ETag": _ROOT_ETAG, "Cache-Control": "public, max-age=60"})
 @app.post("/token", response_model=Token, tags=["User"])
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), session: Session = Depends(get_session)):
-    user = session.get(User, form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password): raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
-    access_token = create_access_token(data={"sub": user.email}); return {"access_token": access_token, "token_type": "bearer"}
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), session: AsyncSession = Depends(get_session)):
+    # Seule la colonne hashed_password est lue : pas de matérialisation ORM du User complet
+    hashed = (await session.exec(select(User.hashed_password).where(User.email == form_data.username))).first()
+    if hashed is None: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
+    pw_key = _pw_cache_key(form_data.username, form_data.password)
+    if pw_key not in _PW_CACHE:
+        if not await anyio.to_thread.run_sync(verify_password, form_data.password, hashed): raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
+        _PW_CACHE[pw_key] = True
+    if password_needs_rehash(hashed):  # migration transparente des anciens hashes
+        new_hash = await anyio.to_thread.run_sync(get_password_hash, form_data.password)
+        await session.exec(update(User).where(User.email == form_data.username).values(hashed_password=new_hash)); await session.commit()
+    access_token = create_access_token(data={"sub": form_data.username}); return {"access_token": access_token, "token_type": "bearer"}
 @app.post("/users/register", response_model=UserPublic, status_code=status.HTTP_201_CREATED, tags=["User"])
-def create_user(user: UserCreate, session: Session = Depends(get_session)):
-    if session.get(User, user.email): raise HTTPException(status_code=400, detail="Email already registered")
-    db_user = User(email=user.email, hashed_password=get_password_hash(user.password)); session.add(db_user); session.commit(); session.refresh(db_user)
+async def create_user(user: UserCreate, session: AsyncSession = Depends(get_session)):
+    if await session.get(User, user.email): raise HTTPException(status_code=400, detail="Email already registered")
+    hashed_password = await anyio.to_thread.run_sync(get_password_hash, user.password)
+    db_user = User(email=user.email, hashed_password=hashed_password); session.add(db_user); await session.commit(); await session.refresh(db_user)
     return db_user
 @app.get("/users/me", response_model=UserPublic, tags=["User"])
 async def read_users_me(current_user: User = Depends(get_current_user)): return current_user
 @app.put("/users/me", response_model=UserPublic, tags=["User"])
-async def update_user_me(user_update: UserUpdate, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
+async def update_user_me(user_update: UserUpdate, current_user: User = Depends(get_current_user), session: AsyncSession = Depends(get_session)):
     user_data = user_update.model_dump(exclude_unset=True)
     for key, value in user_data.items(): setattr(current_user, key, value)
-    session.add(current_user); session.commit(); session.refresh(current_user)
+    session.add(current_user); await session.commit(); await session.refresh(current_user)
+    invalidate_user_cache(current_user.email)  # le profil vient de changer
     return current_user
 @app.get("/consultations", response_model=List[ConsultationPublic], tags=["Analysis"])
-async def read_consultations(current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    return session.exec(select(Consultation).where(Consultation.owner_email == current_user.email)).all()
+async def read_consultations(limit: int = 50, offset: int = 0, current_user: User = Depends(get_current_user), session: AsyncSession = Depends(get_session)):
+    # page bornée la plus récente d'abord : l'index composite évite tri et scan complets
+    stmt = (select(Consultation).where(Consultation.owner_email == current_user.email)
+            .order_by(Consultation.created_at.desc()).limit(min(limit, 200)).offset(offset))
+    return (await session.exec(stmt)).all()
 @app.post("/analysis", response_model=AnalysisResponse, tags=["Analysis"])
 async def analyze_symptoms(request: SymptomRequest, current_user: User = Depends(get_current_user)):
-    GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-    if not GOOGLE_API_KEY: raise HTTPException(status_code=500, detail="Clé API Google non configurée.")
-    genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel('gemini-1.5-pro-latest')
-    user_profile_context = f"Contexte patient: Âge {current_user.age}, Sexe {current_user.sex}."
-    prompt = f'{user_profile_context}\nAnalyse: "{request.symptoms}".\nRéponse JSON...'
+    if GEMINI_MODEL is None: raise HTTPException(status_code=500, detail="Clé API Google non configurée.")
+    profile = user_profile_context(current_user)
+    symptoms_norm = normalize_symptoms(request.symptoms)
+    cache_key = (symptoms_norm, profile)
+    cached = ANALYSIS_CACHE.get(cache_key)
+    if cached is not None: return cached
+    rkey = "analysis:" + hashlib.blake2b(f"{profile}|{symptoms_norm}".encode(), digest_size=16).hexdigest()
+    remote = await redis_get_json(rkey)
+    if remote is not None:
+        result = _ANALYSIS_TA.validate_python(remote); ANALYSIS_CACHE[cache_key] = result
+        return result
+    sem_vec = None
+    if SEMANTIC_CACHE_ENABLED:
+        try:  # l'étage sémantique ne doit jamais faire échouer l'analyse
+            sem_vec = await embed_for_cache(f"{profile} {symptoms_norm}")
+            hit = semantic_lookup(sem_vec)
+            if hit is not None: ANALYSIS_CACHE[cache_key] = hit; return hit
+        except Exception: sem_vec = None
     try:
-        response = model.generate_content(prompt); analysis_data = json.loads(response.text.strip().replace("```json", "").replace("```", ""))
-        return AnalysisResponse(**analysis_data)
+        analysis_data = await submit_analysis(profile, request.symptoms)
+        result = _ANALYSIS_TA.validate_python(analysis_data); ANALYSIS_CACHE[cache_key] = result
+        await redis_set_json(rkey, analysis_data)
+        if sem_vec is not None: semantic_store(sem_vec, result)
+        return result
     except Exception as e: raise HTTPException(status_code=503, detail=f"Erreur IA: {e}")
+@app.post("/analysis/stream", tags=["Analysis"])
+async def analyze_symptoms_stream(request: SymptomRequest, current_user: User = Depends(get_current_user)):
+    """Variante streaming de /analysis : les champs partent au fil de la génération
+    (NDJSON), la dernière ligne contient l'objet d'analyse complet."""
+    if GEMINI_MODEL is None: raise HTTPException(status_code=500, detail="Clé API Google non configurée.")
+    prompt = build_analysis_prompt(user_profile_context(current_user), request.symptoms)
+    return StreamingResponse(stream_gemini_ndjson(GEMINI_MODEL, prompt), media_type="application/x-ndjson")
+async def persist_consultation(symptom: str, final_recommendation: str, severity_level: str, owner_email: str):
+    # session dédiée : la session de la requête est déjà refermée quand la tâche s'exécute
+    async with AsyncSession(engine) as session:
+        session.add(Consultation(symptom=symptom, final_recommendation=final_recommendation, severity_level=severity_level, owner_email=owner_email))
+        await session.commit()
+async def run_refine(request, current_user: User, background_tasks: BackgroundTasks) -> RefineResponse:
+    """Coeur de /analysis/refine, partagé avec l'endpoint combiné refine+médecins."""
+    history = request.history[-6:]  # borne le prompt : seuls les derniers tours comptent (règle des ~5 questions)
+    history_str = build_history_str(history)
+    profile = user_profile_context(current_user)
+    cache_key = (normalize_symptoms(request.symptoms), profile, tuple((h.question, h.answer) for h in history))
+    cached = REFINE_CACHE.get(cache_key)
+    if cached is not None:
+        if cached.final_recommendation:  # la consultation doit être tracée même sur hit cache
+            background_tasks.add_task(persist_consultation, request.symptoms, cached.final_recommendation, cached.severity_level, current_user.email)
+        return cached
+    rkey = "refine:" + hashlib.blake2b(orjson.dumps(cache_key), digest_size=16).hexdigest()
+    refine_data = await redis_get_json(rkey)
+    if refine_data is None:
+        ctx = build_refine_context(profile, request.symptoms, history_str)
+        # flash pour les décisions courtes, pro seulement pour la recommandation finale
+        done_data, question_data = await asyncio.gather(ask_gemini_json(ctx + _PROMPT_CLASSIFY, FAST_MODEL), ask_gemini_json(ctx + _PROMPT_NEXT_QUESTION, FAST_MODEL))
+        if done_data.get("done"): refine_data = await ask_gemini_json(ctx + _PROMPT_RECOMMENDATION)
+        else: refine_data = question_data
+        await redis_set_json(rkey, refine_data)
+    if refine_data.get("final_recommendation"):
+        # écrit après l'envoi de la réponse : le fsync sort du chemin critique utilisateur
+        background_tasks.add_task(persist_consultation, request.symptoms, refine_data["final_recommendation"], refine_data["severity_level"], current_user.email)
+    result = _REFINE_TA.validate_python(refine_data); REFINE_CACHE[cache_key] = result
+    return result
 @app.post("/analysis/refine", response_model=RefineResponse, tags=["Analysis"])
-async def refine_analysis(request: RefineRequest, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-    if not GOOGLE_API_KEY: raise HTTPException(status_code=500, detail="Clé API Google non configurée.")
-    genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel('gemini-1.5-pro-latest')
-    history_str = "\n".join([f"Q: {h['question']}\nA: {h['answer']}" for h in request.history])
-    user_profile_context = f"Contexte patient: Âge {current_user.age}, Sexe {current_user.sex}."
-    prompt = f'{user_profile_context}\nSymptômes: "{request.symptoms}".\nHistorique: {history_str}\nTACHE: ...'
+async def refine_analysis(request: RefineRequest, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user)):
+    if GEMINI_MODEL is None: raise HTTPException(status_code=500, detail="Clé API Google non configurée.")
+    try: return await run_refine(request, current_user, background_tasks)
+    except Exception as e: raise HTTPException(status_code=503, detail=f"Erreur IA: {e}")
+async def nearby_doctors(latitude: float, longitude: float) -> List[Doctor]:
+    if not SETTINGS.google_maps_api_key: raise HTTPException(status_code=500, detail="Service de géolocalisation non configuré.")
+    key = geohash6(latitude, longitude)
+    cached = PLACES_CACHE.get(key)
+    if cached is not None: return cached
+    lock = _PLACES_LOCKS.setdefault(key, asyncio.Lock())
     try:
-        response = model.generate_content(prompt); refine_data = json.loads(response.text.strip().replace("```json", "").replace("```", ""))
-        if refine_data.get("final_recommendation"):
-            new_consultation = Consultation(symptom=request.symptoms, final_recommendation=refine_data["final_recommendation"], severity_level=refine_data["severity_level"], owner_email=current_user.email)
-            session.add(new_consultation); session.commit()
-        return RefineResponse(**refine_data)
+        async with lock:
+            cached = PLACES_CACHE.get(key)  # un concurrent a pu remplir le cache pendant l'attente
+            if cached is not None: return cached
+            # appel direct à l'API Places via le pool httpx partagé : non bloquant, keep-alive HTTP/2
+            resp = await HTTP_CLIENT.get(_PLACES_NEARBY_URL, params={
+                "location": f"{latitude},{longitude}", "radius": 5000,
+                "keyword": "médecin généraliste", "language": "fr", "key": SETTINGS.google_maps_api_key})
+            resp.raise_for_status()
+            places_result = orjson.loads(resp.content)
+            # model_construct : données Google déjà conformes, on saute la validation pydantic
+            doctors = [Doctor.model_construct(name=p.get('name'), address=p.get('vicinity'), rating=p.get('rating'), url=_PLACE_URL + p.get('place_id', '')) for p in islice(places_result.get('results', ()), 3)]
+            PLACES_CACHE[key] = doctors
+            return doctors
+    finally:
+        _PLACES_LOCKS.pop(key, None)
+@app.post("/analysis/refine_with_doctors", response_model=RefineWithDoctorsResponse, tags=["Analysis"])
+async def refine_with_doctors(request: RefineWithDoctorsRequest, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user)):
+    """Enchaînement refine + médecins proches en un aller-retour : les deux appels
+    externes partent en parallèle, le coût mur est max(t_llm, t_maps) et non la somme."""
+    if GEMINI_MODEL is None: raise HTTPException(status_code=500, detail="Clé API Google non configurée.")
+    try:
+        refine, doctors = await asyncio.gather(run_refine(request, current_user, background_tasks), nearby_doctors(request.latitude, request.longitude))
+        return RefineWithDoctorsResponse(refine=refine, doctors=doctors)
+    except HTTPException: raise
     except Exception as e: raise HTTPException(status_code=503, detail=f"Erreur IA: {e}")
 @app.post("/doctors/nearby", response_model=List[Doctor], tags=["Geolocation"])
-def find_nearby_doctors(request: NearbyDoctorsRequest):
-    GOOGLE_MAPS_API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY")
-    if not GOOGLE_MAPS_API_KEY: raise HTTPException(status_code=500, detail="Service de géolocalisation non configuré.")
-    gmaps = googlemaps.Client(key=GOOGLE_MAPS_API_KEY)
-    try:
-        places_result = gmaps.places_nearby(location=(request.latitude, request.longitude), radius=5000, keyword="médecin généraliste", language="fr")
-        return [Doctor(name=p.get('name'), address=p.get('vicinity'), rating=p.get('rating'), url=f"https://www.google.com/maps/place/?q=place_id:{p.get('place_id')}") for p in places_result.get('results', [])[:3]]
-    except Exception as e: raise HTTPException(status_code=503, detail=f"Erreur du service de géolocalisation: {e}")
\ No newline at end of file
+async def find_nearby_doctors(request: NearbyDoctorsRequest):
+    try: return await nearby_doctors(request.latitude, request.longitude)
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(status_code=503, detail=f"Erreur du service de géolocalisation: {e}")
+@app.post("/dev/cache/flush", tags=["Dev"])
+def flush_caches():
+    global _semantic_vectors
+    ANALYSIS_CACHE.clear(); REFINE_CACHE.clear()
+    _semantic_vectors = None; _semantic_payloads.clear()
+    return {"status": "Caches IA vidés."}
\ No newline at end of file